@@ -31,7 +31,10 @@ PADDING_EDGE = 100
 
 # folder s
 LAND_COVER_FILE = "./CA_forest_VLCE_2015/CA_forest_VLCE_2015.tif"
+TILED_LAND_COVER_FILE = "./CA_forest_VLCE_2015/CA_forest_VLCE_2015_tiled.tif"
 TRAIN_DATASETS = 'train'
 TEST_DATASETS = 'test'
+REGISTERED_DATASETS = 'registered'
+FINGERPRINTS_FOLDER = 'fingerprints'
 
 SUPPORTED_BANDS = [2, 3, 4, 5, 6, 7]
@@ -1,5 +1,4 @@
 import matplotlib.pyplot as plt
-from rasterio.windows import from_bounds
 import numpy as np
 import cv2 as cv
 from pathlib import Path
@@ -10,7 +9,8 @@ from skimage.exposure import equalize_hist
 from os import walk
 import re
 
-from config import LAND_COVER_FILE, SUPPORTED_BANDS, REFLECTANCE_MAX_BAND, PADDING_EDGE
+from config import SUPPORTED_BANDS, REFLECTANCE_MAX_BAND, PADDING_EDGE
+from preprocessing.landcover_store import get_land_cover_reader
 
 
 def merge_reprojected_bands(datasets_folder):
@@ -25,7 +25,7 @@ def merge_reprojected_bands(datasets_folder):
             datasets_dict['dataset%d' % i] = str(Path(root, Path(file).stem[:-1]))
             i += 1
 
-    ds = rasterio.open(LAND_COVER_FILE)
+    ds = get_land_cover_reader()
     for dataset, files in datasets_dict.items():
         # get dimensions and transformation form the first band in the dataset
         with rasterio.open(Path(files + '2').with_suffix('.TIF'), read='r+') as band:
@@ -102,57 +102,56 @@ def rotate_datasets(landsat_dataset_path, enhance_colors=False, show_preprocessi
         if not label:
             return ls_cropped
 
-        with rasterio.open(LAND_COVER_FILE) as ds:
-            # reading a window oo landcover dataset according to landsat boundries
-            lc_original = ds.read(1, window=from_bounds(west, south, east, north, transform=ds.transform))
-            # perform affine transformation of landcover
-            lc_rotated = cv.warpAffine(lc_original, M, (h, w),
-                                       flags=cv.INTER_NEAREST,
-                                       borderMode=cv.BORDER_CONSTANT)
-
-            # masking land cover dataset
-            lc_masked = lc_rotated * mask
-
-            # crop
-            lc_cropped = lc_masked[np.ix_(np.unique(x), np.unique(y))]
-
-            # remove padding on the edges
-            lc_cropped = lc_cropped[PADDING_EDGE:-PADDING_EDGE, PADDING_EDGE:-PADDING_EDGE]
-
-            # enhance colors
-            if enhance_colors:
-                ls_cropped[:, :, 0] = equalize_hist(ls_cropped[:, :, 0])
-                ls_cropped[:, :, 1] = equalize_hist(ls_cropped[:, :, 1])
-                ls_cropped[:, :, 2] = equalize_hist(ls_cropped[:, :, 2])
-
-            # show steps
-            if show_preprocessing_steps:
-                fig, ax = plt.subplots(nrows=2, ncols=4)
-                ax[0][0].imshow(ls_original)
-                ax[1][0].imshow(lc_original, cmap='nipy_spectral')
-                ax[0][0].title.set_text('original')
-                ax[0][0].set_axis_off()
-                ax[1][0].set_axis_off()
-
-                ax[0][1].imshow(ls_rotated)
-                ax[1][1].imshow(lc_rotated, cmap='nipy_spectral')
-                ax[0][1].title.set_text('rotated')
-                ax[0][1].set_axis_off()
-                ax[1][1].set_axis_off()
-
-                ax[0][2].imshow(ls_rotated)
-                ax[1][2].imshow(lc_masked, cmap='nipy_spectral')
-                ax[0][2].title.set_text('masked')
-                ax[0][2].set_axis_off()
-                ax[1][2].set_axis_off()
-
-                ax[0][3].imshow(ls_cropped)
-                ax[1][3].imshow(lc_cropped, cmap='nipy_spectral')
-                ax[0][3].title.set_text('cropped ')
-                ax[0][3].set_axis_off()
-                ax[1][3].set_axis_off()
-                plt.show()
-            return ls_cropped, lc_cropped
+        # reading a window oo landcover dataset according to landsat boundries
+        lc_original = get_land_cover_reader().read(west, south, east, north)
+        # perform affine transformation of landcover
+        lc_rotated = cv.warpAffine(lc_original, M, (h, w),
+                                   flags=cv.INTER_NEAREST,
+                                   borderMode=cv.BORDER_CONSTANT)
+
+        # masking land cover dataset
+        lc_masked = lc_rotated * mask
+
+        # crop
+        lc_cropped = lc_masked[np.ix_(np.unique(x), np.unique(y))]
+
+        # remove padding on the edges
+        lc_cropped = lc_cropped[PADDING_EDGE:-PADDING_EDGE, PADDING_EDGE:-PADDING_EDGE]
+
+        # enhance colors
+        if enhance_colors:
+            ls_cropped[:, :, 0] = equalize_hist(ls_cropped[:, :, 0])
+            ls_cropped[:, :, 1] = equalize_hist(ls_cropped[:, :, 1])
+            ls_cropped[:, :, 2] = equalize_hist(ls_cropped[:, :, 2])
+
+        # show steps
+        if show_preprocessing_steps:
+            fig, ax = plt.subplots(nrows=2, ncols=4)
+            ax[0][0].imshow(ls_original)
+            ax[1][0].imshow(lc_original, cmap='nipy_spectral')
+            ax[0][0].title.set_text('original')
+            ax[0][0].set_axis_off()
+            ax[1][0].set_axis_off()
+
+            ax[0][1].imshow(ls_rotated)
+            ax[1][1].imshow(lc_rotated, cmap='nipy_spectral')
+            ax[0][1].title.set_text('rotated')
+            ax[0][1].set_axis_off()
+            ax[1][1].set_axis_off()
+
+            ax[0][2].imshow(ls_rotated)
+            ax[1][2].imshow(lc_masked, cmap='nipy_spectral')
+            ax[0][2].title.set_text('masked')
+            ax[0][2].set_axis_off()
+            ax[1][2].set_axis_off()
+
+            ax[0][3].imshow(ls_cropped)
+            ax[1][3].imshow(lc_cropped, cmap='nipy_spectral')
+            ax[0][3].title.set_text('cropped ')
+            ax[0][3].set_axis_off()
+            ax[1][3].set_axis_off()
+            plt.show()
+        return ls_cropped, lc_cropped
 
 
 def getMultiSpectral(landsat_dataset_path):
@@ -0,0 +1,161 @@
+import json
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import rasterio
+from rasterio.windows import Window, from_bounds, bounds as window_bounds
+
+from config import LAND_COVER_FILE, TILED_LAND_COVER_FILE
+
+
+def build_tiled_landcover(src_path=LAND_COVER_FILE, dst_path=TILED_LAND_COVER_FILE, tile_size=512):
+    """
+    Converts the land cover raster into an internally tiled and compressed GeoTiff and saves the
+    (row, col) positions of all tiles containing data next to it (<dst_path>.json)
+    :param src_path: str
+        path of the original land cover raster
+    :param dst_path: str
+        path of the tiled land cover raster
+    :param tile_size: int
+        width and height of the tiles in pixels, must be a multiple of 16
+    """
+    tiles = []
+    with rasterio.open(src_path) as src:
+        profile = src.profile.copy()
+        profile.update(driver='GTiff', count=1, tiled=True, blockxsize=tile_size, blockysize=tile_size,
+                       compress='deflate', BIGTIFF='IF_SAFER')
+        with rasterio.open(dst_path, 'w', **profile) as dst:
+            for row_off in range(0, src.height, tile_size):
+                print('Tiling land cover rows %d/%d' % (row_off, src.height))
+                height = min(tile_size, src.height - row_off)
+                # read a strip of one tile height and split it into tiles
+                strip = src.read(1, window=Window(0, row_off, src.width, height))
+                dst.write(strip, 1, window=Window(0, row_off, src.width, height))
+                for col_off in range(0, src.width, tile_size):
+                    if strip[:, col_off:col_off + tile_size].any():
+                        tiles.append([row_off // tile_size, col_off // tile_size])
+
+    with open(str(dst_path) + '.json', 'w') as index_file:
+        json.dump(dict(tile_size=tile_size, tiles=tiles), index_file)
+
+    # the store must give the same labels as the original raster, otherwise it is discarded
+    reader = LandCoverReader(dst_path)
+    try:
+        verify_land_cover_reader(reader, src_path)
+    except ValueError:
+        Path(str(dst_path) + '.json').unlink()
+        raise
+    finally:
+        reader.close()
+
+
+class LandCoverReader:
+    """
+    Reads windows of the land cover raster tile by tile and caches the most recently used tiles,
+    so that overlapping scenes do not read the same tiles again.
+    The covering tiles are found from the geotransform. Tiles missing in the non-empty tile list
+    of a tiled store contain no data and are not read at all.
+    """
+
+    def __init__(self, path=TILED_LAND_COVER_FILE, cache_size=512, tile_size=512):
+        index_path = Path(str(path) + '.json')
+        if not index_path.exists():
+            # no tiled store yet, read the original raster in tiles of the default size
+            path = LAND_COVER_FILE
+        self.ds = rasterio.open(path)
+        self.crs = self.ds.crs
+        self.res = self.ds.res
+        self.transform = self.ds.transform
+        self.dtype = self.ds.dtypes[0]
+        if index_path.exists():
+            with open(str(index_path)) as index_file:
+                index = json.load(index_file)
+            self.tile_size = index['tile_size']
+            self.tiles = {(tile[0], tile[1]) for tile in index['tiles']}
+        else:
+            self.tile_size = tile_size
+            self.tiles = None
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def close(self):
+        self.cache.clear()
+        self.ds.close()
+
+    def read_tile(self, row, col):
+        if self.tiles is not None and (row, col) not in self.tiles:
+            return None
+        if (row, col) in self.cache:
+            self.cache.move_to_end((row, col))
+            return self.cache[(row, col)]
+        row_off, col_off = row * self.tile_size, col * self.tile_size
+        tile = self.ds.read(1, window=Window(col_off, row_off,
+                                             min(self.tile_size, self.ds.width - col_off),
+                                             min(self.tile_size, self.ds.height - row_off)))
+        self.cache[(row, col)] = tile
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return tile
+
+    def read_pixels(self, row_start, row_stop, col_start, col_stop):
+        """
+        Reads the pixels of the given integer window, pixels outside of the raster are 0
+        """
+        res = np.zeros((row_stop - row_start, col_stop - col_start), dtype=self.dtype)
+
+        # copy the overlapping part of every covering tile into the result
+        for row in range(max(row_start, 0) // self.tile_size, (min(row_stop, self.ds.height) - 1) // self.tile_size + 1):
+            for col in range(max(col_start, 0) // self.tile_size,
+                             (min(col_stop, self.ds.width) - 1) // self.tile_size + 1):
+                tile = self.read_tile(row, col)
+                if tile is None:
+                    continue
+                tile_row, tile_col = row * self.tile_size, col * self.tile_size
+                r0, r1 = max(row_start, tile_row), min(row_stop, tile_row + tile.shape[0])
+                c0, c1 = max(col_start, tile_col), min(col_stop, tile_col + tile.shape[1])
+                res[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = \
+                    tile[r0 - tile_row:r1 - tile_row, c0 - tile_col:c1 - tile_col]
+        return res
+
+    def read(self, west, south, east, north):
+        """
+        Reads the window of the land cover raster covering the given bounds. Like a windowed read of the
+        raster, the (fractional) window is sampled with nearest neighbour, i.e. every output pixel takes the
+        land cover pixel under its center.
+        """
+        window = from_bounds(west, south, east, north, transform=self.transform)
+        height, width = int(round(window.height)), int(round(window.width))
+        rows = np.floor(window.row_off + (np.arange(height) + 0.5) * window.height / height).astype(int)
+        cols = np.floor(window.col_off + (np.arange(width) + 0.5) * window.width / width).astype(int)
+        pixels = self.read_pixels(rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+        return pixels[np.ix_(rows - rows[0], cols - cols[0])]
+
+
+def verify_land_cover_reader(reader, src_path=LAND_COVER_FILE, samples=20, size=1000):
+    """
+    Checks that the reader returns the same labels as a windowed read of the original raster
+    for random fractional windows
+    """
+    rng = np.random.default_rng()
+    with rasterio.open(src_path) as src:
+        for _ in range(samples):
+            row_off = rng.uniform(0, src.height - size)
+            col_off = rng.uniform(0, src.width - size)
+            west, south, east, north = window_bounds(Window(col_off, row_off, size, size), src.transform)
+            expected = src.read(1, window=from_bounds(west, south, east, north, transform=src.transform))
+            if not np.array_equal(reader.read(west, south, east, north), expected):
+                raise ValueError('Land cover reader differs from the windowed read at %s' %
+                                 str((west, south, east, north)))
+
+
+_land_cover_reader = None
+
+
+def get_land_cover_reader():
+    """
+    Returns the land cover reader shared by all scenes so that cached tiles are reused
+    """
+    global _land_cover_reader
+    if _land_cover_reader is None:
+        _land_cover_reader = LandCoverReader()
+    return _land_cover_reader
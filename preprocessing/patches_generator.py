@@ -21,13 +21,25 @@ classes_names = list(original_classes.keys())
 model_classes = {c: idx for idx, c in enumerate(classes_names)}
 
 
+def class_lookup_table(class_assignment=None):
+    """
+    Builds a lookup table which maps the original land cover values to the model classes,
+    i.e. the index of the class in class_assignment. Not assigned classes are mapped to 0.
+    """
+    if not class_assignment:
+        class_assignment = classes_names
+    lut = np.zeros(256, dtype=np.uint8)
+    for index, c in enumerate(class_assignment):
+        lut[original_classes[c]] = index
+    return lut
+
+
 def generate_patches(train_image, label_image, train_flag=True, bands=None,
                      class_assignment=[], data_id='',
                      patch_size=256,
                      patches_per_map=15):
-    # get all classes if no specific were given
-    if len(class_assignment) == 0:
-        class_assignment = classes_names
+    # maps the original land cover values to the model classes
+    lut = class_lookup_table(class_assignment)
 
     # calculate random indices to get patches
     sampling_weights = label_image[patch_size // 2:-patch_size // 2, patch_size // 2:-patch_size // 2].astype(np.float_)
@@ -49,11 +61,9 @@ def generate_patches(train_image, label_image, train_flag=True, bands=None,
             y = idx // sampling_weights.shape[1]
             input_patch = train_image[y:y + patch_size, x:x + patch_size, :]
             label_patch = label_image[y:y + patch_size, x:x + patch_size]
-            label_patch_converted = np.zeros_like(label_patch)
 
             # create categorical mask
-            for index, c in enumerate(class_assignment, start=1):
-                label_patch_converted[label_patch == original_classes[c]] = index
+            label_patch_converted = lut[label_patch.astype(np.uint8)]
             ######
             # TODO consider of having pixel-wise balance across the dataset
             ######
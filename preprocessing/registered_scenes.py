@@ -0,0 +1,108 @@
+from pathlib import Path
+import numpy as np
+from tensorflow.keras.utils import Sequence
+
+from config import original_classes, selected_classes, REFLECTANCE_MAX_BAND
+from preprocessing.patches_generator import class_lookup_table
+
+
+def save_registered_scene(train_image, label_image, out_folder, data_id=''):
+    """
+    Stores a registered scene as returned by rotate_datasets in raw .npy format,
+    so it can be memory-mapped later without decoding.
+    The reflectance is stored as uint16 like in the original bands, hence without loss.
+    :param train_image: ndarray
+        multi-spectral image (height, width, bands) normalized to [0, 1]
+    :param label_image: ndarray
+        land cover labels (height, width) with the original class values
+    :param out_folder: str
+        folder where the scene is saved
+    :param data_id: str
+        id of the scene used as file prefix
+    """
+    Path(out_folder).mkdir(parents=True, exist_ok=True)
+    np.save(str(Path(out_folder, '%s_image.npy' % data_id)), np.round(train_image * REFLECTANCE_MAX_BAND).astype(np.uint16))
+    np.save(str(Path(out_folder, '%s_label.npy' % data_id)), label_image.astype(np.uint8))
+
+
+def load_registered_scenes(folder):
+    """
+    Memory-maps all registered scenes saved by save_registered_scene in the given folder
+    :returns: list of (image, label) memory-mapped pairs
+    """
+    scenes = []
+    for image_path in sorted(Path(folder).glob('*_image.npy')):
+        label_path = Path(str(image_path).replace('_image.npy', '_label.npy'))
+        scenes.append((np.load(str(image_path), mmap_mode='r'), np.load(str(label_path), mmap_mode='r')))
+    return scenes
+
+
+class RandomWindowSequence(Sequence):
+    """
+    Provides batches of randomly sampled windows from memory-mapped registered scenes.
+    Every batch of the train subset draws fresh window positions, hence every epoch sees new patches.
+    The last validation_split fraction of rows of each scene is kept for validation, its windows
+    are the same in every epoch so that the validation loss is comparable across epochs.
+    """
+
+    def __init__(self, folder, batch_size=16, patch_size=256, steps_per_epoch=100, subset='train',
+                 validation_split=0.2, class_assignment=selected_classes, seed=None, max_tries=20):
+        self.scenes = load_registered_scenes(folder)
+        if len(self.scenes) == 0:
+            raise FileNotFoundError('No registered scenes found in %s' % folder)
+        self.batch_size = batch_size
+        self.patch_size = patch_size
+        self.steps_per_epoch = steps_per_epoch
+        self.max_tries = max_tries
+        self.lut = class_lookup_table(class_assignment)
+        self.num_classes = len(class_assignment) if class_assignment else len(original_classes)
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.subset = subset
+        self.epoch = 0
+
+        # row range per scene in which the upper left corner of a window may lie
+        self.row_ranges = []
+        for image, _ in self.scenes:
+            split = int(image.shape[0] * (1 - validation_split))
+            if subset == 'train':
+                self.row_ranges.append((0, split - patch_size))
+            else:
+                self.row_ranges.append((split, image.shape[0] - patch_size))
+        if all(stop <= start for start, stop in self.row_ranges):
+            raise ValueError('Scenes are too small for patches of size %d' % patch_size)
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def on_epoch_end(self):
+        if self.subset == 'train':
+            self.epoch += 1
+
+    def sample_window(self, rng):
+        while True:
+            scene_idx = rng.integers(len(self.scenes))
+            start, stop = self.row_ranges[scene_idx]
+            if stop > start:
+                break
+        image, label = self.scenes[scene_idx]
+        # prefer windows centered on a labeled pixel like generate_patches does
+        for _ in range(self.max_tries):
+            y = rng.integers(start, stop)
+            x = rng.integers(0, image.shape[1] - self.patch_size)
+            if label[y + self.patch_size // 2, x + self.patch_size // 2] != 0:
+                break
+        return image[y:y + self.patch_size, x:x + self.patch_size, :], \
+            label[y:y + self.patch_size, x:x + self.patch_size]
+
+    def __getitem__(self, idx):
+        # seeding with epoch and batch index keeps background workers from drawing the same windows
+        rng = np.random.default_rng([self.seed, self.epoch, idx])
+        x = np.empty((self.batch_size, self.patch_size, self.patch_size, self.scenes[0][0].shape[2]),
+                     dtype=np.float32)
+        y = np.empty((self.batch_size, self.patch_size, self.patch_size), dtype=np.uint8)
+        for i in range(self.batch_size):
+            image_patch, label_patch = self.sample_window(rng)
+            x[i] = image_patch / REFLECTANCE_MAX_BAND
+            # remap the original land cover values at read time
+            y[i] = self.lut[label_patch]
+        return x, np.eye(self.num_classes, dtype=np.float32)[y]
@@ -1,16 +1,22 @@
 from pathlib import Path
-from config import selected_classes, TRAIN_DATASETS, TEST_DATASETS
+from config import selected_classes, TRAIN_DATASETS, TEST_DATASETS, REGISTERED_DATASETS, TILED_LAND_COVER_FILE
 from patches_generator import generate_patches
 from image_registration import merge_reprojected_bands, rotate_datasets
+from registered_scenes import save_registered_scene
+from landcover_store import build_tiled_landcover
+
+# convert the land cover dataset once into a tiled store for fast label reads
+if not Path(TILED_LAND_COVER_FILE + '.json').exists():
+    build_tiled_landcover()
 
 # reproject each dataset then obtain a list of paths
 reprojected_train_datasets = merge_reprojected_bands(TRAIN_DATASETS)
 reprojected_test_datasets = merge_reprojected_bands(TEST_DATASETS)
 
-# create patches from the training datasets
+# save the registered training datasets, patches are sampled from them on the fly while training
 for i, dataset in enumerate(reprojected_train_datasets):
-    generate_patches(*rotate_datasets(Path(TRAIN_DATASETS, '%s.tif' % dataset)), train_flag=True, data_id=i.__str__(),
-                     class_assignment=selected_classes, patches_per_map=1300)
+    save_registered_scene(*rotate_datasets(Path(TRAIN_DATASETS, '%s.tif' % dataset)), out_folder=REGISTERED_DATASETS,
+                          data_id=i.__str__())
 
 # create patches from the testing datasets
 for i, dataset in enumerate(reprojected_test_datasets):
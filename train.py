@@ -3,4 +3,4 @@ import pickle
 from u_net import UNET
 
 model = UNET(batch_size=16, epochs=300)
-model.train()
+model.train_on_scenes()
@@ -1,5 +1,6 @@
 import os
 import pickle
+import hashlib
 from pathlib import Path
 import rasterio
 from PIL import Image
@@ -13,8 +14,9 @@ from tensorflow.python.keras.layers import Conv2DTranspose, Dropout
 from tensorflow.python.keras.optimizer_v2.adam import Adam
 from tensorflow.python.keras.preprocessing.image import ImageDataGenerator
 
-from config import selected_classes, colors, colors_legend
+from config import selected_classes, colors, colors_legend, REGISTERED_DATASETS, FINGERPRINTS_FOLDER
 from preprocessing.image_registration import rotate_datasets, getMultiSpectral
+from preprocessing.registered_scenes import RandomWindowSequence
 from tensorflow.keras import backend as K
 
 
@@ -44,6 +46,57 @@ def getTeilsGenerator(w, h, window_size, trim, in_image):
             yield in_image[:, x:x_overflow, y:y_overflow, :], x, y, x_overflow, y_overflow
 
 
+def getAnchoredTeilsGenerator(w, h, window_size, trim, in_image, x_start, y_start):
+    """
+    Like getTeilsGenerator, but the windows start at the (possibly negative) offsets x_start, y_start,
+    so that they lie on a grid anchored in map coordinates. Windows are cut off at the image border.
+    """
+    stepSize = window_size - trim * 2
+    for y in range(y_start, h, stepSize):
+        for x in range(x_start, w, stepSize):
+            x_overflow = min(x + window_size, w)
+            y_overflow = min(y + window_size, h)
+            yield in_image[:, max(x, 0):x_overflow, max(y, 0):y_overflow, :], x, y, x_overflow, y_overflow
+
+
+def getWindowOffsets(length, window_size, stride):
+    """
+    Returns the offsets of windows along one axis so that the last window ends at the image border
+    """
+    offsets = list(range(0, max(length - window_size, 0) + 1, stride))
+    if offsets[-1] + window_size < length:
+        offsets.append(length - window_size)
+    return offsets
+
+
+def getBlendingTeilsGenerator(w, h, window_size, stride, in_image):
+    for y in getWindowOffsets(h, window_size, stride):
+        for x in getWindowOffsets(w, window_size, stride):
+            x_overflow = min(x + window_size, w)
+            y_overflow = min(y + window_size, h)
+            yield in_image[:, x:x_overflow, y:y_overflow, :], x, y, x_overflow, y_overflow
+
+
+def getBlendingWeights(window_size, floor=1e-3):
+    """
+    Center-peaked (Hann) weights of a window, clamped to a floor which is representable in float16
+    so that pixels at the image border covered by a single window still get a prediction
+    """
+    weights = np.hanning(window_size + 2)[1:-1]
+    return np.maximum(np.outer(weights, weights), floor)
+
+
+def getWindowFingerprint(window, block_size=16):
+    """
+    Fingerprints the input of a window by its block-wise mean reflectance quantized to 8 bit
+    :returns: hash of the quantized reflectance and the quantized reflectance itself
+    """
+    _, ws_x, ws_y, bands = window.shape
+    blocks = window[0].reshape(ws_x // block_size, block_size, ws_y // block_size, block_size, bands)
+    signature = np.round(blocks.mean(axis=(1, 3)) * 255).astype(np.uint8)
+    return hashlib.sha1(signature.tobytes()).hexdigest(), signature
+
+
 
 class UNET:
     def __init__(self, batch_size=64, epochs=30, window_size=256):
@@ -138,13 +191,29 @@ class UNET:
             yield np.concatenate((next(X_train_RGB)[0], next(X_train_NIR)[0]), axis=3), np.eye(len(selected_classes))[
                 np.squeeze(next(y_train)[0]).astype(int)]
 
-    def train(self):
+    def fit(self, train_data, validation_data, **kwargs):
+        """
+        Fits the model with checkpointing of the best weights and early stopping on the validation loss,
+        then saves the training history
+        :param kwargs:
+            further arguments passed to model.fit, e.g. steps or workers
+        """
         checkpoint = ModelCheckpoint(self.weight_file, verbose=1, monitor='val_loss', save_best_only=True, mode='min')
         early_stop = EarlyStopping(monitor='val_loss',
                                    min_delta=0,
                                    patience=3,
                                    verbose=0, mode='auto')
 
+        self.history = self.model.fit(train_data,
+                                      epochs=self.epochs,
+                                      validation_data=validation_data,
+                                      callbacks=[checkpoint, early_stop],
+                                      **kwargs)
+
+        with open('history.json', 'wb') as file_pi:
+            pickle.dump(self.history.history, file_pi)
+
+    def train(self):
         train_gen = self.multi_spectral_image_generator('train')
         val_gen = self.multi_spectral_image_generator('validation')
 
@@ -152,15 +221,30 @@ class UNET:
         _, _, num_of_val = next(os.walk(str(Path('dataset', 'validation', 'RGBinputs', 'input'))))
 
         print('Start training with %d images and %d images for validation' % (len(num_of_train), len(num_of_val)))
-        self.history = self.model.fit(train_gen,
-                                      steps_per_epoch=len(num_of_train) // self.batch_size,
-                                      epochs=self.epochs,
-                                      validation_steps=len(num_of_val) // self.batch_size,
-                                      validation_data=val_gen,
-                                      callbacks=[checkpoint, early_stop])
+        self.fit(train_gen, val_gen,
+                 steps_per_epoch=len(num_of_train) // self.batch_size,
+                 validation_steps=len(num_of_val) // self.batch_size)
 
-        with open('history.json', 'wb') as file_pi:
-            pickle.dump(self.history.history, file_pi)
+    def train_on_scenes(self, folder=REGISTERED_DATASETS, steps_per_epoch=100, validation_steps=20, workers=4):
+        """
+        Trains the model on random windows sampled on the fly from the memory-mapped registered scenes
+        saved by preprocessing/run.py, so no patches have to be generated beforehand
+        :param folder: str
+            folder containing the registered scenes
+        :param steps_per_epoch: int
+            number of batches sampled per epoch
+        :param validation_steps: int
+            number of batches sampled for validation
+        :param workers: int
+            number of background workers sampling the batches
+        """
+        train_seq = RandomWindowSequence(folder, batch_size=self.batch_size, patch_size=self.window_size,
+                                         steps_per_epoch=steps_per_epoch, subset='train')
+        val_seq = RandomWindowSequence(folder, batch_size=self.batch_size, patch_size=self.window_size,
+                                       steps_per_epoch=validation_steps, subset='validation')
+
+        print('Start training on %d registered scenes' % len(train_seq.scenes))
+        self.fit(train_seq, val_seq, workers=workers, use_multiprocessing=workers > 1)
 
     def test(self):
         """
@@ -205,7 +289,8 @@ class UNET:
             plt.legend(handles=colors_legend, borderaxespad=-15, fontsize='x-small')
             plt.show()
 
-    def estimate_raw_landsat(self, path: Path, trim=20):
+    def estimate_raw_landsat(self, path: Path, trim=20, blend=False, stride=None, incremental=False,
+                             change_threshold=0.02, path_row=None):
         """
          Estimates the full map image by sliding a window over and
            trimming off sides from each side of 256*256 patch
@@ -216,7 +301,26 @@ class UNET:
             e.g. 100 -> adds only the middle 56*56 square of the 256*256 patch to the result.
            The trimming is used to avoid creases and artifacts since patch-wise prediction
            has no knowledge of nearby structures from the next patch.
+        :param blend: bool
+            if True, the class probabilities of overlapping windows are blended with center-peaked
+            weights and the argmax is taken once over the blended probabilities instead of trimming
+        :param stride: int
+            step between windows when blending, defaults to the step of the trimmed tiling
+            (window size - 2 * trim). Must not be larger than the window size.
+        :param incremental: bool
+            if True, only windows whose input changed since the previous run of the same path/row are
+            predicted again, the classification of the other windows is copied from the previous run.
+            The windows lie on a grid anchored in map coordinates, so a previous run is used as long as it has
+            the same CRS, resolution, tiling, model weights and classes and its pixels are aligned with the
+            pixels of the scene, even if the extents of the scenes differ. Not supported together with blend.
+        :param change_threshold: float
+            a window is predicted again if the mean reflectance of any of its 16*16 pixel blocks changed by more
+            than change_threshold in any band (reflectance normalized to [0, 1])
+        :param path_row: str
+            WRS-2 path/row of the scene, parsed from the folder name (e.g. LC08_L2SP_035024 -> 035024) if not given
         """
+        if incremental and blend:
+            raise ValueError('Incremental classification is only supported without blending')
         multi_image = [rasterio.open(band_path) for band_path in list(Path(path).glob('*SR_B[2-7].TIF'))]
         profile = multi_image[0].meta.copy()
         profile.update(count=7)
@@ -229,7 +333,30 @@ class UNET:
         self.model.load_weights(self.weight_file)
         w, h, _ = input_map.shape
         in_image = np.reshape(input_map, (1, input_map.shape[0], input_map.shape[1], input_map.shape[2]))
-        res = np.zeros((input_map.shape[0], input_map.shape[1]))
+        if blend:
+            res = self.blend_windows(in_image, stride or self.window_size - 2 * trim)
+        elif incremental:
+            fingerprints_path = Path(FINGERPRINTS_FOLDER, '%s.npz' % (path_row or Path(path).name.split('_')[2]))
+            previous = self.load_fingerprints(fingerprints_path, trim, metadata)
+            res, fingerprints, reused = self.incremental_trim_windows(in_image, trim, previous, change_threshold)
+            print('Reused %.1f%% of the tiles from the previous run' % (100 * reused / max(len(fingerprints), 1)))
+            origin = previous['origin'] if previous is not None else \
+                (metadata['transform'].c, metadata['transform'].f)
+            self.save_fingerprints(fingerprints_path, fingerprints, origin, trim, metadata)
+        else:
+            res = self.trim_windows(in_image, trim)
+        assert res.shape[0] == w and res.shape[1] == h
+        print(res.shape[0], res.shape[1])
+        res *= mask
+        with rasterio.open(Path(path, 'classified_landcover.tif'), 'w', **metadata) as dst:
+            dst.write(res.astype(rasterio.uint8), 1)
+
+    def trim_windows(self, in_image, trim):
+        """
+        Predicts every window and keeps only its middle part without the trimmed sides
+        """
+        _, w, h, _ = in_image.shape
+        res = np.zeros((w, h))
         for window_data, x, y, x_overflow, y_overflow in getTeilsGenerator(w, h, self.window_size, trim, in_image):
             window = np.zeros((1, self.window_size, self.window_size, self.bands))
             window[:, :window_data.shape[1], :window_data.shape[2], :] = window_data
@@ -239,9 +366,133 @@ class UNET:
                                                     trim:window_data.shape[1] - trim,
                                                     trim:window_data.shape[2] - trim],
                                                     axis=2)
-        assert res.shape[0] == w and res.shape[1] == h
-        print(res.shape[0], res.shape[1])
-        res *= mask
-        with rasterio.open(Path(path, 'classified_landcover.tif'), 'w', **metadata) as dst:
-            dst.write(res.astype(rasterio.uint8), 1)
+        return res
+
+    def incremental_trim_windows(self, in_image, trim, previous=None, change_threshold=0.02):
+        """
+        Like trim_windows, but the windows lie on a grid anchored at the origin of the fingerprint store
+        and are keyed by their position on that grid, i.e. on the ground
+        :param previous: dict
+            origin, offset and windows of a previous run as returned by load_fingerprints.
+            Windows whose fingerprint did not change are copied from it instead of being predicted,
+            they keep the fingerprint of the previous run so that it always belongs to the input of
+            the stored classification and small changes cannot add up unnoticed over several runs.
+        :param change_threshold: float
+            largest allowed change of the mean reflectance of a block in any band for a window to be reused
+        :returns: the classification, the fingerprints and classified cores of all windows
+            and the number of reused windows
+        """
+        _, w, h, _ = in_image.shape
+        step = self.window_size - 2 * trim
+        # pixel offset of the scene on the grid, the first window's middle part covers the first row and column
+        row_offset, col_offset = previous['offset'] if previous is not None else (0, 0)
+        x_start = -trim - (row_offset - trim) % step
+        y_start = -trim - (col_offset - trim) % step
+        res = np.zeros((w, h))
+        fingerprints = dict()
+        reused = 0
+        for window_data, x, y, x_overflow, y_overflow in getAnchoredTeilsGenerator(w, h, self.window_size, trim,
+                                                                                  in_image, x_start, y_start):
+            # middle part of the window inside the image
+            r0, r1 = max(x + trim, 0), min(x + self.window_size - trim, w)
+            c0, c1 = max(y + trim, 0), min(y + self.window_size - trim, h)
+            if r1 <= r0 or c1 <= c0:
+                continue
+            window = np.zeros((1, self.window_size, self.window_size, self.bands))
+            window[:, max(-x, 0):max(-x, 0) + window_data.shape[1],
+                   max(-y, 0):max(-y, 0) + window_data.shape[2], :] = window_data
+            key = ((x + row_offset) // step, (y + col_offset) // step)
+            fingerprint_hash, signature = getWindowFingerprint(window)
+            if previous is not None and key in previous['windows']:
+                previous_hash, previous_signature, previous_core = previous['windows'][key]
+                # decide per block so that local changes are not diluted by the rest of the window
+                if fingerprint_hash == previous_hash or np.max(
+                        np.abs(signature.astype(np.float32) - previous_signature)) / 255 <= change_threshold:
+                    res[r0:r1, c0:c1] = previous_core[r0 - x - trim:r1 - x - trim, c0 - y - trim:c1 - y - trim]
+                    fingerprints[key] = previous['windows'][key]
+                    reused += 1
+                    continue
+            output = self.model.predict(window, verbose=0).squeeze(axis=0)
+            res[r0:r1, c0:c1] = np.argmax(output[r0 - x:r1 - x, c0 - y:c1 - y], axis=2)
+            core = np.zeros((step, step), dtype=np.uint8)
+            core[r0 - x - trim:r1 - x - trim, c0 - y - trim:c1 - y - trim] = res[r0:r1, c0:c1]
+            fingerprints[key] = (fingerprint_hash, signature, core)
+        return res, fingerprints, reused
+
+    def model_fingerprint(self):
+        """
+        Hash of the model weights and the selected classes, which identifies the model producing a classification
+        """
+        model_hash = hashlib.sha1()
+        with open(self.weight_file, 'rb') as weights:
+            for chunk in iter(lambda: weights.read(1 << 20), b''):
+                model_hash.update(chunk)
+        model_hash.update(','.join(selected_classes).encode())
+        return model_hash.hexdigest()
+
+    def load_fingerprints(self, fingerprints_path, trim, metadata, tolerance=1e-6):
+        """
+        Loads the window fingerprints and classified cores of the previous run of a path/row together with
+        the pixel offset of the scene to the origin of the stored grid.
+        Returns None if there is no previous run with the same CRS, resolution, tiling and model or if the
+        pixels of the scene are not aligned with the stored grid, since otherwise the copied classes would
+        not belong to the same ground pixels.
+        """
+        if not Path(fingerprints_path).exists():
+            return None
+        transform = metadata['transform']
+        with np.load(str(fingerprints_path)) as previous:
+            if int(previous['trim']) != trim or int(previous['window_size']) != self.window_size or \
+                    str(previous['crs']) != metadata['crs'].to_string() or \
+                    not np.allclose(previous['resolution'], (transform.a, transform.e), rtol=0, atol=tolerance) or \
+                    transform.b != 0 or transform.d != 0 or \
+                    str(previous['model']) != self.model_fingerprint():
+                return None
+            origin = tuple(previous['origin'])
+            row_offset = (transform.f - origin[1]) / transform.e
+            col_offset = (transform.c - origin[0]) / transform.a
+            if abs(row_offset - round(row_offset)) > tolerance or abs(col_offset - round(col_offset)) > tolerance:
+                return None
+            windows = {tuple(key): (fingerprint_hash, signature, core) for key, fingerprint_hash, signature, core in
+                       zip(previous['keys'].tolist(), previous['hashes'], previous['signatures'], previous['cores'])}
+            return dict(origin=origin, offset=(int(round(row_offset)), int(round(col_offset))), windows=windows)
+
+    def save_fingerprints(self, fingerprints_path, fingerprints, origin, trim, metadata):
+        """
+        Saves the window fingerprints and classified cores (before masking) of the current run
+        keyed by their position on the grid anchored at origin
+        """
+        Path(fingerprints_path).parent.mkdir(parents=True, exist_ok=True)
+        transform = metadata['transform']
+        np.savez_compressed(str(fingerprints_path),
+                            keys=np.array(list(fingerprints.keys())),
+                            hashes=np.array([fingerprint_hash for fingerprint_hash, _, _ in fingerprints.values()]),
+                            signatures=np.array([signature for _, signature, _ in fingerprints.values()]),
+                            cores=np.array([core for _, _, core in fingerprints.values()]),
+                            origin=np.array(origin),
+                            resolution=np.array((transform.a, transform.e)),
+                            trim=trim,
+                            window_size=self.window_size,
+                            crs=metadata['crs'].to_string(),
+                            model=self.model_fingerprint())
+
+    def blend_windows(self, in_image, stride):
+        """
+        Accumulates the weighted class probabilities of overlapping windows and takes the argmax once.
+        The weights are not normalized since the argmax of a pixel does not depend on its total weight.
+        """
+        if not 0 < stride <= self.window_size:
+            raise ValueError('The stride must be between 1 and the window size %d' % self.window_size)
+        _, w, h, _ = in_image.shape
+        weights = getBlendingWeights(self.window_size)[..., np.newaxis]
+        probabilities = np.zeros((w, h, len(selected_classes)), dtype=np.float16)
+        for window_data, x, y, x_overflow, y_overflow in getBlendingTeilsGenerator(w, h, self.window_size, stride,
+                                                                                  in_image):
+            window = np.zeros((1, self.window_size, self.window_size, self.bands))
+            window[:, :window_data.shape[1], :window_data.shape[2], :] = window_data
+            output = self.model.predict(window, verbose=0).squeeze(axis=0)
+            output = output[:window_data.shape[1], :window_data.shape[2]] * \
+                weights[:window_data.shape[1], :window_data.shape[2]]
+            probabilities[x:x_overflow, y:y_overflow] += output.astype(np.float16)
+        return np.argmax(probabilities, axis=2).astype(np.float64)
 